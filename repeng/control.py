@@ -46,6 +46,10 @@ class ControlModel(torch.nn.Module):
     def device(self) -> torch.device:
         return self.model.device
 
+    @property
+    def dtype(self) -> torch.dtype:
+        return self.model.dtype
+
     def unwrap(self) -> PreTrainedModel:
         """
         Removes the mutations done to the wrapped model and returns it.
@@ -1,10 +1,10 @@
 import dataclasses
+import operator
 import typing
 import warnings
 
 import gguf
 import numpy as np
-from sklearn.decomposition import PCA
 import torch
 from transformers import PreTrainedModel, PreTrainedTokenizerBase
 import tqdm
@@ -22,6 +22,15 @@ class DatasetEntry:
 class ControlVector:
     model_type: str
     directions: dict[int, np.ndarray]
+    # optional dense (n_layers, hidden_dim) store set by `train` and arithmetic, so arithmetic
+    # can run as one op over all layers. `directions` holds row views of it, and so does
+    # `_stacked_rows`, which is used to notice if `directions` was modified since
+    _stacked: np.ndarray | None = dataclasses.field(
+        default=None, repr=False, compare=False
+    )
+    _stacked_rows: dict[int, np.ndarray] | None = dataclasses.field(
+        default=None, repr=False, compare=False
+    )
 
     @classmethod
     def train(
@@ -37,7 +46,9 @@ class ControlVector:
             dataset,
             **kwargs,
         )
-        return cls(model_type=model.config.model_type, directions=dirs)
+        return cls._from_stacked(
+            model.config.model_type, list(dirs), np.stack(list(dirs.values()))
+        )
 
     def export_gguf(self, path: str):
         """
@@ -56,12 +67,43 @@ class ControlVector:
         writer.add_string(f"{arch}.model_hint", self.model_type)
         writer.add_uint32(f"{arch}.layer_count", len(self.directions))
         for layer in self.directions.keys():
-            writer.add_tensor(f"direction.{layer}", self.directions[layer])
+            # llama.cpp only loads f32 directions
+            writer.add_tensor(
+                f"direction.{layer}", self.directions[layer].astype(np.float32)
+            )
         writer.write_header_to_file()
         writer.write_kv_data_to_file()
         writer.write_tensors_to_file()
         writer.close()
 
+    @staticmethod
+    def _from_stacked(
+        model_type: str, layers: list[int], stacked: np.ndarray
+    ) -> "ControlVector":
+        """
+        Build a ControlVector backed by `stacked` (n_layers, hidden_dim), whose directions are
+        its rows.
+        """
+        directions = dict(zip(layers, stacked))
+        return ControlVector(
+            model_type=model_type,
+            directions=directions,
+            _stacked=stacked,
+            _stacked_rows=dict(directions),
+        )
+
+    def _current_stacked(self) -> np.ndarray | None:
+        """
+        Return the dense store if `directions` is still exactly its rows, otherwise (no store,
+        or a direction was added, removed, or reassigned) `None`.
+        """
+        rows = self._stacked_rows
+        if rows is None or list(rows) != list(self.directions):
+            return None
+        if not all(map(operator.is_, rows.values(), self.directions.values())):
+            return None
+        return self._stacked
+
     def _helper_combine(
         self, other: "ControlVector", other_coeff: float
     ) -> "ControlVector":
@@ -71,6 +113,24 @@ class ControlVector:
             )
 
         model_type = self.model_type
+        stacked, other_stacked = self._current_stacked(), other._current_stacked()
+        if (
+            stacked is not None
+            and other_stacked is not None
+            and list(self.directions) == list(other.directions)
+            and stacked.shape == other_stacked.shape
+        ):
+            # avoid a separate multiply for the common + and - cases
+            if other_coeff == 1:
+                combined = stacked + other_stacked
+            elif other_coeff == -1:
+                combined = stacked - other_stacked
+            else:
+                combined = stacked + other_coeff * other_stacked
+            return ControlVector._from_stacked(
+                model_type, list(self.directions), combined
+            )
+
         directions: dict[int, np.ndarray] = {}
         for layer in self.directions:
             directions[layer] = self.directions[layer]
@@ -97,12 +157,24 @@ class ControlVector:
         return self._helper_combine(other, -1)
 
     def __neg__(self) -> "ControlVector":
+        stacked = self._current_stacked()
+        if stacked is not None:
+            return ControlVector._from_stacked(
+                self.model_type, list(self.directions), -stacked
+            )
+
         directions: dict[int, np.ndarray] = {}
         for layer in self.directions:
             directions[layer] = -self.directions[layer]
         return ControlVector(model_type=self.model_type, directions=directions)
 
     def __mul__(self, other: int | float | np.int_ | np.float_) -> "ControlVector":
+        stacked = self._current_stacked()
+        if stacked is not None:
+            return ControlVector._from_stacked(
+                self.model_type, list(self.directions), other * stacked
+            )
+
         directions: dict[int, np.ndarray] = {}
         for layer in self.directions:
             directions[layer] = other * self.directions[layer]
@@ -121,68 +193,85 @@ def read_representations(
     inputs: list[DatasetEntry],
     hidden_layers: typing.Iterable[int] | None = None,
     batch_size: int = 32,
+    hidden_layers_normalized: bool = False,
+    compile_model: bool = False,
 ) -> dict[int, np.ndarray]:
     """
     Extract the representations based on the contrast dataset.
+
+    Pass `hidden_layers_normalized=True` if `hidden_layers` are already all non-negative
+    layer indexes (e.g. when training many vectors for the same layers in a sweep) to skip
+    normalizing them again.
+
+    Pass `compile_model=True` to run the forward passes through `torch.compile` on cuda. See
+    `batched_get_hiddens`.
+
+    Performance notes, so changes here target the right bottleneck:
+    - The model forward passes in `batched_get_hiddens` are compute-bound, so they're sped up
+      by lower precision (bf16 autocast of fp32 models), less padding (length bucketing), and
+      compilation.
+    - Everything after them (last-token selection, the copy to host, and the PCA / sign
+      calculation below) is memory-bound, with several O(n_inputs * hidden_dim) passes per
+      layer. Keep it to as few copies as possible and batch work across layers with stacked
+      arrays, rather than going back to per-layer loops or building Python lists.
     """
 
     if not hidden_layers:
         hidden_layers = range(-1, -model.config.num_hidden_layers, -1)
-
-    # normalize the layer indexes if they're negative
-    n_layers = len(model_layer_list(model))
-    hidden_layers = [i if i >= 0 else n_layers + i for i in hidden_layers]
+        hidden_layers_normalized = False
+
+    if hidden_layers_normalized:
+        hidden_layers = list(hidden_layers)
+        assert all(
+            i >= 0 for i in hidden_layers
+        ), "hidden_layers_normalized=True, but hidden_layers has negative layer ids"
+    else:
+        # normalize the layer indexes if they're negative
+        n_layers = len(model_layer_list(model))
+        hidden_layers = [i if i >= 0 else n_layers + i for i in hidden_layers]
 
     # the order is [positive, negative, positive, negative, ...]
     train_strs = [s for ex in inputs for s in (ex.positive, ex.negative)]
 
     layer_hiddens = batched_get_hiddens(
-        model, tokenizer, train_strs, hidden_layers, batch_size
+        model, tokenizer, train_strs, hidden_layers, batch_size, compile_model
     )
 
-    # get differences between (positive, negative) pairs
-    relative_layer_hiddens = {}
-    for layer in hidden_layers:
-        relative_layer_hiddens[layer] = (
-            layer_hiddens[layer][::2] - layer_hiddens[layer][1::2]
-        )
-
-    # get directions for each layer using PCA
-    directions: dict[int, np.ndarray] = {}
-    for layer in tqdm.tqdm(hidden_layers):
+    # get differences between (positive, negative) pairs, written straight into one
+    # array of shape (n_layers, n_inputs, hidden_dim)
+    first_hiddens = layer_hiddens[hidden_layers[0]]
+    relative_hiddens = np.empty(
+        (len(hidden_layers), len(inputs), first_hiddens.shape[1]),
+        dtype=first_hiddens.dtype,
+    )
+    for i, layer in enumerate(hidden_layers):
         assert layer_hiddens[layer].shape[0] == len(inputs) * 2
-
-        # fit layer directions
-        train = np.vstack(
-            relative_layer_hiddens[layer]
-            - relative_layer_hiddens[layer].mean(axis=0, keepdims=True)
-        )
-        pca_model = PCA(n_components=1, whiten=False).fit(train)
-        # shape (n_features,)
-        directions[layer] = pca_model.components_.astype(np.float32).squeeze(axis=0)
-
-        # calculate sign
-        projected_hiddens = project_onto_direction(
-            layer_hiddens[layer], directions[layer]
+        np.subtract(
+            layer_hiddens[layer][::2],
+            layer_hiddens[layer][1::2],
+            out=relative_hiddens[i],
         )
 
-        # order is [positive, negative, positive, negative, ...]
-        positive_smaller_mean = np.mean(
-            [
-                projected_hiddens[i] < projected_hiddens[i + 1]
-                for i in range(0, len(inputs) * 2, 2)
-            ]
-        )
-        positive_larger_mean = np.mean(
-            [
-                projected_hiddens[i] > projected_hiddens[i + 1]
-                for i in range(0, len(inputs) * 2, 2)
-            ]
-        )
-
-        if positive_smaller_mean > positive_larger_mean:  # type: ignore
-            directions[layer] *= -1
-
+    # get directions for each layer using PCA, batched across layers
+    # center in place, keeping the mean around to undo it for the sign calculation
+    relative_means = relative_hiddens.mean(axis=1, keepdims=True)
+    relative_hiddens -= relative_means
+    # shape (n_layers, hidden_dim)
+    components = batched_top_component(relative_hiddens).astype(np.float32)
+
+    # calculate sign
+    # projecting (positive - negative) onto a direction gives the same result as projecting
+    # each and subtracting, so do that for every layer at once. only the sign matters here,
+    # so skip dividing by the (unit) direction norm. shape (n_layers, n_inputs)
+    pair_diffs = np.einsum("lnd,ld->ln", relative_hiddens, components)
+    pair_diffs += np.einsum("lnd,ld->ln", relative_means, components)
+    positive_smaller_mean = (pair_diffs < 0).mean(axis=1)
+    positive_larger_mean = (pair_diffs > 0).mean(axis=1)
+    components[positive_smaller_mean > positive_larger_mean] *= -1
+
+    directions: dict[int, np.ndarray] = {
+        layer: components[i] for i, layer in enumerate(hidden_layers)
+    }
     return directions
 
 
@@ -192,31 +281,116 @@ def batched_get_hiddens(
     inputs: list[str],
     hidden_layers: list[int],
     batch_size: int,
+    compile_model: bool = False,
 ) -> dict[int, np.ndarray]:
     """
     Using the given model and tokenizer, pass the inputs through the model and get the hidden
     states for each layer in `hidden_layers` for the last token.
 
+    If `compile_model` is set and the model is on cuda, the forward passes go through
+    `torch.compile(mode="reduce-overhead")`, and batches are padded to a multiple of 64
+    tokens so only a few shapes get compiled (hidden states are still taken from each input's
+    last real token). This only pays off for larger datasets, since each new shape costs a
+    compile.
+
     Returns a dictionary from `hidden_layers` layer id to an numpy array of shape `(n_inputs, hidden_dim)`
     """
-    batched_inputs = [
-        inputs[p : p + batch_size] for p in range(0, len(inputs), batch_size)
+    # tokenize everything once, unpadded, and pad each batch as it's used
+    encodings = tokenizer(inputs)
+    # batch similar-length inputs together to minimize padding, then write each batch's
+    # hidden states back to the inputs' original positions
+    lengths = [len(ids) for ids in encodings["input_ids"]]
+    order = np.argsort(lengths, kind="stable")
+    batched_indices = [
+        order[p : p + batch_size] for p in range(0, len(inputs), batch_size)
     ]
-    hidden_states = {layer: [] for layer in hidden_layers}
-    with torch.no_grad():
-        for batch in tqdm.tqdm(batched_inputs):
-            out = model(
-                **tokenizer(batch, padding=True, return_tensors="pt").to(model.device),
-                output_hidden_states=True,
-            )
-            for layer in hidden_layers:
-                # if not indexing from end, account for embedding hiddens
-                hidden_idx = layer + 1 if layer >= 0 else layer
-                for batch in out.hidden_states[hidden_idx]:
-                    hidden_states[layer].append(batch[-1, :].squeeze().cpu().numpy())
-            del out
-
-    return {k: np.vstack(v) for k, v in hidden_states.items()}
+    # allocated on the first batch, once we know the output dtype and device of each layer
+    hidden_states: dict[int, torch.Tensor] = {}
+    # only autocast fp32 models on cuda devices with bf16 support (not e.g. T4 / V100), where
+    # bf16 matmuls are fast. fp16 / bf16 models and other devices keep the model's own dtype
+    autocast = torch.autocast(
+        device_type="cuda",
+        dtype=torch.bfloat16,
+        enabled=model.device.type == "cuda"
+        and model.dtype == torch.float32
+        and torch.cuda.is_bf16_supported(),
+    )
+    # on cuda, copy from pinned memory without blocking, so the host can go on padding the
+    # next batch while this one's copy and forward are still queued
+    pin = model.device.type == "cuda"
+
+    def to_device(t: torch.Tensor, device: torch.device | None = None) -> torch.Tensor:
+        device = device or model.device
+        if pin:
+            return t.pin_memory().to(device, non_blocking=True)
+        return t.to(device)
+
+    # cuda graphs (from reduce-overhead) need static shapes, so pad to a few bucket lengths.
+    # on either padding side, the extra padding doesn't leak into the results, since positions
+    # are counted from each row's first non-padding token and its last one is gathered below
+    if compile_model and model.device.type == "cuda":
+        forward = torch.compile(model, mode="reduce-overhead", dynamic=False)
+        pad_to_multiple_of = 64
+    else:
+        forward = model
+        pad_to_multiple_of = None
+
+    # since the lengths are needed up front anyway, padding the encodings beats re-tokenizing
+    # each batch, so skip transformers' advice (logged on fast tokenizers) to call the
+    # tokenizer instead of `pad`, restoring the tokenizer's own state afterwards
+    pad_warning = "Asking-to-pad-a-fast-tokenizer"
+    pad_warned = tokenizer.deprecation_warnings.get(pad_warning)
+    tokenizer.deprecation_warnings[pad_warning] = True
+    try:
+        with torch.inference_mode(), autocast:
+            for indices in tqdm.tqdm(batched_indices):
+                batch = {k: [v[i] for i in indices] for k, v in encodings.items()}
+                model_inputs = tokenizer.pad(
+                    batch, pad_to_multiple_of=pad_to_multiple_of, return_tensors="pt"
+                )
+                # count positions from each row's first non-padding token, and take the hidden
+                # states of its last non-padding token, so that whichever side the tokenizer pads
+                # on, which inputs share a batch doesn't change their hidden states
+                mask = model_inputs["attention_mask"]
+                model_inputs["position_ids"] = (mask.cumsum(dim=1) - 1).clamp(min=0)
+                last_token = (mask * torch.arange(mask.shape[1])).argmax(dim=1)
+                index_tensors = (
+                    torch.from_numpy(indices),
+                    torch.arange(len(indices)),
+                    last_token,
+                )
+                # moved to each device the hidden states are on once per batch, rather than
+                # having every layer's indexing implicitly copy them from the host
+                device_index_tensors = {}
+                out = forward(
+                    **{k: to_device(v) for k, v in model_inputs.items()},
+                    output_hidden_states=True,
+                )
+                for layer in hidden_layers:
+                    # if not indexing from end, account for embedding hiddens
+                    hidden_idx = layer + 1 if layer >= 0 else layer
+                    layer_hiddens = out.hidden_states[hidden_idx]
+                    if layer_hiddens.device not in device_index_tensors:
+                        device_index_tensors[layer_hiddens.device] = [
+                            to_device(t, layer_hiddens.device) for t in index_tensors
+                        ]
+                    batch_index, rows, cols = device_index_tensors[layer_hiddens.device]
+                    # keep the last token's hidden states on device, copying once at the end
+                    last_hiddens = layer_hiddens[rows, cols]
+                    if layer not in hidden_states:
+                        hidden_states[layer] = last_hiddens.new_empty(
+                            (len(inputs), last_hiddens.shape[-1])
+                        )
+                    hidden_states[layer][batch_index] = last_hiddens
+                del out
+    finally:
+        if pad_warned is None:
+            del tokenizer.deprecation_warnings[pad_warning]
+        else:
+            tokenizer.deprecation_warnings[pad_warning] = pad_warned
+
+    # numpy has no bf16, so upcast after the (half-size) copy to host
+    return {k: v.cpu().float().numpy() for k, v in hidden_states.items()}
 
 
 def project_onto_direction(H, direction):
@@ -224,3 +398,31 @@ def project_onto_direction(H, direction):
     mag = np.linalg.norm(direction)
     assert not np.isinf(mag)
     return (H @ direction) / mag
+
+
+def batched_top_component(X: np.ndarray) -> np.ndarray:
+    """
+    Find the first principal component of each already-centered matrix in X (l, n, d).
+
+    Returns an array of shape (l, d) of unit vectors with the same dtype as X. Like PCA, the
+    sign of each component is arbitrary.
+    """
+    _, n, d = X.shape
+    if n < d:
+        # eigendecompose the (n, n) gram matrix instead of the (d, d) covariance, then map the
+        # top eigenvector back into feature space
+        gram = X @ X.transpose(0, 2, 1)
+        w, u = np.linalg.eigh(gram.astype(np.float64))
+    else:
+        cov = X.transpose(0, 2, 1) @ X
+        w, v = np.linalg.eigh(cov.astype(np.float64))
+
+    if np.any(w[:, -1] <= 0):
+        raise ValueError(
+            "can't find a direction for data with no variance (is the dataset a single entry?)"
+        )
+
+    if n < d:
+        v = (u[:, None, :, -1].astype(X.dtype) @ X).squeeze(axis=1)
+        return v / np.linalg.norm(v, axis=1, keepdims=True)
+    return v[:, :, -1].astype(X.dtype)
@@ -2,10 +2,21 @@ import functools
 import json
 import pathlib
 
+import numpy as np
+import pytest
+import tokenizers
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, PreTrainedTokenizerBase
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    GPT2Config,
+    GPT2LMHeadModel,
+    PreTrainedTokenizerBase,
+    PreTrainedTokenizerFast,
+)
 
 from . import ControlModel, ControlVector, DatasetEntry
+from .extract import batched_get_hiddens, batched_top_component
 
 
 @functools.lru_cache(maxsize=1)
@@ -118,3 +129,150 @@ def test_train():
         sad
         == "I am a fucking idiot. I'm not even trying to get you out of here, but if it's"
     )
+
+
+def test_batched_top_component():
+    rng = np.random.default_rng(0)
+    # (n, d) for both the gram (n < d) and covariance (n >= d) paths
+    for n, d in [(10, 32), (40, 8)]:
+        X = rng.normal(size=(3, n, d)).astype(np.float32)
+        X = X - X.mean(axis=1, keepdims=True)
+
+        components = batched_top_component(X)
+        assert components.shape == (3, d)
+        assert components.dtype == np.float32
+        for layer in range(3):
+            expected = np.linalg.svd(X[layer].astype(np.float64))[2][0]
+            # the sign of a principal component is arbitrary
+            assert np.isclose(abs(components[layer] @ expected), 1.0, atol=1e-4)
+
+    # a single centered row is all zeros, so there's no direction to find
+    with pytest.raises(ValueError):
+        batched_top_component(np.zeros((2, 1, 8), dtype=np.float32))
+
+
+def load_tiny_model(
+    padding_side: str,
+) -> tuple[PreTrainedTokenizerBase, GPT2LMHeadModel]:
+    """A tiny randomly-initialized model and word-level tokenizer, so no downloads are needed."""
+
+    words = ["<pad>", "a", "b", "c", "d"]
+    tok = tokenizers.Tokenizer(
+        tokenizers.models.WordLevel(
+            {w: i for i, w in enumerate(words)}, unk_token="<pad>"
+        )
+    )
+    tok.pre_tokenizer = tokenizers.pre_tokenizers.Whitespace()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tok, pad_token="<pad>", padding_side=padding_side
+    )
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(
+        GPT2Config(vocab_size=len(words), n_positions=80, n_embd=8, n_layer=2, n_head=2)
+    ).eval()
+    return tokenizer, model
+
+
+@pytest.mark.parametrize("padding_side", ["right", "left"])
+def test_batched_get_hiddens_ignores_padding(padding_side: str):
+    tokenizer, model = load_tiny_model(padding_side)
+
+    inputs = ["a b c", "d", "c d a b", "b", "a a"]
+    unbatched = batched_get_hiddens(model, tokenizer, inputs, [0, 1], batch_size=1)
+    batched = batched_get_hiddens(model, tokenizer, inputs, [0, 1], batch_size=4)
+    # the silenced pad advice is restored for the caller's own `pad` calls
+    assert "Asking-to-pad-a-fast-tokenizer" not in tokenizer.deprecation_warnings
+    for layer in [0, 1]:
+        assert unbatched[layer].shape == (len(inputs), 8)
+        assert np.allclose(unbatched[layer], batched[layer], atol=1e-5)
+
+
+@pytest.mark.parametrize("padding_side", ["right", "left"])
+def test_batched_get_hiddens_ignores_bucket_padding(
+    padding_side: str, monkeypatch: pytest.MonkeyPatch
+):
+    # compile_model=True pads batches to a multiple of 64 tokens on cuda, so force that here
+    tokenizer, model = load_tiny_model(padding_side)
+
+    inputs = ["a b c", "d", "c d a b", "b", "a a"]
+    expected = batched_get_hiddens(model, tokenizer, inputs, [0, 1], batch_size=4)
+    pad = tokenizer.pad
+    monkeypatch.setattr(
+        tokenizer,
+        "pad",
+        lambda *args, **kwargs: pad(*args, **{**kwargs, "pad_to_multiple_of": 64}),
+    )
+    padded = batched_get_hiddens(model, tokenizer, inputs, [0, 1], batch_size=4)
+    for layer in [0, 1]:
+        assert np.allclose(expected[layer], padded[layer], atol=1e-5)
+
+
+def test_vector_arithmetic_stacked():
+    # trained vectors are backed by one (n_layers, hidden_dim) array
+    stacked = np.arange(12, dtype=np.float32).reshape(3, 4)
+    v = ControlVector._from_stacked("gpt2", [3, 4, 5], stacked)
+    assert v._current_stacked() is stacked
+    for i, layer in enumerate([3, 4, 5]):
+        assert np.array_equal(v.directions[layer], stacked[i])
+
+    for result, expected in [
+        (-v, -stacked),
+        (v * 2, stacked * 2),
+        (2 * v, stacked * 2),
+        (v / 2, stacked / 2),
+        (v + v, stacked * 2),
+        (v - v * 2, -stacked),
+    ]:
+        assert list(result.directions) == [3, 4, 5]
+        # results stay stacked, so chained arithmetic stays vectorized
+        assert result._current_stacked() is not None
+        for i, layer in enumerate([3, 4, 5]):
+            assert np.array_equal(result.directions[layer], expected[i])
+
+
+def test_vector_arithmetic_fallback():
+    stacked = np.arange(12, dtype=np.float32).reshape(3, 4)
+    v = ControlVector._from_stacked("gpt2", [3, 4, 5], stacked)
+
+    # modifying a stacked vector's directions drops it back to the per-layer path
+    reassigned = ControlVector._from_stacked("gpt2", [3, 4, 5], stacked.copy())
+    reassigned.directions[4] = stacked[1] * 3
+    removed = ControlVector._from_stacked("gpt2", [3, 4, 5], stacked.copy())
+    del removed.directions[5]
+    reordered = ControlVector._from_stacked("gpt2", [3, 4, 5], stacked.copy())
+    reordered.directions = {5: stacked[2], 4: stacked[1], 3: stacked[0]}
+    for modified in [reassigned, removed, reordered]:
+        assert modified._current_stacked() is None
+
+    # hand-built vectors have no dense store
+    separate = ControlVector("gpt2", {3: stacked[0].copy(), 4: stacked[1].copy()})
+    assert separate._current_stacked() is None
+    other_layers = ControlVector._from_stacked("gpt2", [4, 6], stacked[:2] + 1)
+
+    # per-layer results regardless of which path is taken, including mixed stacked and
+    # non-stacked operands and mismatched layer sets
+    for a, b in [
+        (v, reassigned),
+        (reassigned, v),
+        (v, removed),
+        (v, reordered),
+        (v, separate),
+        (separate, v),
+        (v, other_layers),
+    ]:
+        for result, coeff in [(a + b, 1), (a - b, -1)]:
+            assert set(result.directions) == set(a.directions) | set(b.directions)
+            for layer, direction in result.directions.items():
+                expected = np.zeros(4, dtype=np.float32)
+                if layer in a.directions:
+                    expected += a.directions[layer]
+                if layer in b.directions:
+                    expected += coeff * b.directions[layer]
+                assert np.array_equal(direction, expected)
+
+    for result, expected in [
+        (-separate, -stacked[:2]),
+        (separate * 3, stacked[:2] * 3),
+    ]:
+        for i, layer in enumerate([3, 4]):
+            assert np.array_equal(result.directions[layer], expected[i])